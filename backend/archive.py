@@ -0,0 +1,151 @@
+"""
+Archivo de trabajos cerrados.
+
+Mueve los vehículos con fecha de salida anterior a un límite configurable
+(junto con sus defectos e historial) a las tablas archived_*, en lotes,
+para que las tablas activas no crezcan indefinidamente.
+"""
+import asyncio
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Optional
+
+from dotenv import load_dotenv
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.orm import Session
+
+import models
+from database import SessionLocal
+from sync import record_vehicle_tombstones
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# Días desde la salida para archivar un vehículo
+ARCHIVE_AFTER_DAYS = int(os.getenv("ARCHIVE_AFTER_DAYS", "180"))
+# Vehículos movidos por transacción
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "200"))
+# Cada cuántas horas corre el job programado (0 = deshabilitado)
+ARCHIVE_INTERVAL_HOURS = float(os.getenv("ARCHIVE_INTERVAL_HOURS", "24"))
+
+# Pares (tabla origen, tabla destino) en orden padre -> hijos
+_HOT_TO_ARCHIVE = [
+    (models.Vehicle.__table__, models.ArchivedVehicle.__table__),
+    (models.Defect.__table__, models.ArchivedDefect.__table__),
+    (models.ServiceHistory.__table__, models.ArchivedServiceHistory.__table__),
+]
+
+
+def _copy_rows(db: Session, source, target, ids, key):
+    """Copiar con INSERT ... SELECT las filas de source cuya columna key esté en ids"""
+    columns = [c.name for c in source.columns if c.name in target.c]
+    db.execute(
+        insert(target).from_select(
+            columns,
+            select(*[source.c[name] for name in columns]).where(source.c[key].in_(ids))
+        )
+    )
+
+
+def _move(db: Session, pairs, ids):
+    """Copiar vehículos y sus hijos de una familia de tablas a otra y borrar el origen"""
+    vehicles, *children = pairs
+    _copy_rows(db, vehicles[0], vehicles[1], ids, "id")
+    for source, target in children:
+        _copy_rows(db, source, target, ids, "vehiculo_id")
+    # Borrar hijos antes que el padre para respetar las llaves foráneas
+    for source, _ in reversed(children):
+        db.execute(delete(source).where(source.c.vehiculo_id.in_(ids)))
+    db.execute(delete(vehicles[0]).where(vehicles[0].c.id.in_(ids)))
+
+
+def archive_closed_vehicles(
+    db: Session,
+    older_than_days: Optional[int] = None,
+    batch_size: Optional[int] = None
+) -> int:
+    """Archivar vehículos cerrados hace más de older_than_days días. Devuelve cuántos se movieron."""
+    days = ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+    size = batch_size or ARCHIVE_BATCH_SIZE
+    cutoff = datetime.utcnow() - timedelta(days=days)
+    total = 0
+
+    while True:
+        ids = db.execute(
+            select(models.Vehicle.id)
+            .where(models.Vehicle.fecha_salida.isnot(None))
+            .where(models.Vehicle.fecha_salida < cutoff)
+            .order_by(models.Vehicle.id)
+            .limit(size)
+        ).scalars().all()
+        if not ids:
+            break
+
+        # Los clientes sincronizados descartan los vehículos archivados
+        record_vehicle_tombstones(db, ids)
+        # archivado_en se llena con el default de la columna
+        _move(db, _HOT_TO_ARCHIVE, ids)
+        # Una transacción por lote para no bloquear la base mucho tiempo
+        db.commit()
+        total += len(ids)
+
+    return total
+
+
+def restore_vehicle(db: Session, vehicle_id: int) -> Optional[models.Vehicle]:
+    """Regresar un vehículo archivado a las tablas activas"""
+    archived = db.get(models.ArchivedVehicle, vehicle_id)
+    if not archived:
+        return None
+
+    pairs = [(target, source) for source, target in _HOT_TO_ARCHIVE]
+    _move(db, pairs, [vehicle_id])
+    # Marcar como cambiados para que la sincronización los vuelva a enviar
+    now = datetime.utcnow()
+    db.execute(update(models.Vehicle).where(models.Vehicle.id == vehicle_id).values(updated_at=now))
+    for model in (models.Defect, models.ServiceHistory):
+        db.execute(update(model).where(model.vehiculo_id == vehicle_id).values(updated_at=now))
+    # Ya no está eliminado para los clientes sincronizados
+    db.execute(
+        delete(models.Tombstone)
+        .where(models.Tombstone.entidad == "vehicle")
+        .where(models.Tombstone.entidad_id == vehicle_id)
+    )
+    db.commit()
+    db.expire_all()
+    return db.get(models.Vehicle, vehicle_id)
+
+
+def get_archived_vehicle(db: Session, vehicle_id: int) -> Optional[models.ArchivedVehicle]:
+    """Buscar un vehículo en el archivo"""
+    return db.get(models.ArchivedVehicle, vehicle_id)
+
+
+def is_archived(db: Session, vehicle_id: int) -> bool:
+    """Saber si un vehículo está en el archivo; las tablas activas se revisan primero por llave primaria"""
+    if db.query(models.Vehicle.id).filter(models.Vehicle.id == vehicle_id).first():
+        return False
+    return db.get(models.ArchivedVehicle, vehicle_id) is not None
+
+
+def run_archive_job() -> int:
+    """Ejecutar un ciclo de archivado con su propia sesión"""
+    db = SessionLocal()
+    try:
+        return archive_closed_vehicles(db)
+    finally:
+        db.close()
+
+
+async def archive_scheduler():
+    """Tarea de fondo que archiva trabajos cerrados periódicamente"""
+    while True:
+        try:
+            archivados = await asyncio.to_thread(run_archive_job)
+            if archivados:
+                logger.info("Archivo: %d vehículos movidos", archivados)
+        except Exception:
+            logger.exception("Error al archivar vehículos")
+        await asyncio.sleep(ARCHIVE_INTERVAL_HOURS * 3600)
@@ -0,0 +1,161 @@
+"""
+Soporte de Idempotency-Key para los POST que crean registros y para las
+operaciones de /api/sync/push.
+
+La primera solicitud con una llave la reclama guardando una fila pendiente;
+la respuesta se guarda en la misma transacción que el registro creado. Los
+reintentos con la misma llave reciben la respuesta original sin tocar las
+tablas del dominio, y los duplicados concurrentes esperan a la primera.
+"""
+import hashlib
+import json
+import os
+import time
+from datetime import datetime, timedelta
+from typing import Optional, Union
+
+from dotenv import load_dotenv
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+from sqlalchemy import delete, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+import models
+
+load_dotenv()
+
+# Horas que se conserva una llave
+IDEMPOTENCY_TTL_HOURS = float(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+# Segundos que un duplicado espera a que termine la solicitud original
+IDEMPOTENCY_WAIT_SECONDS = float(os.getenv("IDEMPOTENCY_WAIT_SECONDS", "10"))
+# Una llave pendiente más vieja que esto se considera abandonada
+IDEMPOTENCY_STALE_SECONDS = 60
+# Frecuencia mínima de limpieza de llaves expiradas
+PURGE_INTERVAL_SECONDS = 600
+MAX_KEY_LENGTH = 64
+
+_last_purge = 0.0
+
+
+def _fingerprint(endpoint: str, payload: BaseModel) -> str:
+    body = json.dumps(payload.model_dump(mode="json"), sort_keys=True)
+    return hashlib.sha256(f"{endpoint}\n{body}".encode()).hexdigest()
+
+
+def purge_expired(db: Session) -> int:
+    """Borrar llaves más viejas que el TTL"""
+    cutoff = datetime.utcnow() - timedelta(hours=IDEMPOTENCY_TTL_HOURS)
+    result = db.execute(
+        delete(models.IdempotencyKey).where(models.IdempotencyKey.created_at < cutoff)
+    )
+    db.commit()
+    return result.rowcount
+
+
+def _maybe_purge(db: Session):
+    global _last_purge
+    now = time.monotonic()
+    if now - _last_purge >= PURGE_INTERVAL_SECONDS:
+        _last_purge = now
+        purge_expired(db)
+
+
+def _claim(db: Session, key: str, request_hash: str) -> bool:
+    """Intentar reclamar la llave; False si ya existe"""
+    db.add(models.IdempotencyKey(key=key, request_hash=request_hash))
+    try:
+        db.commit()
+        return True
+    except IntegrityError:
+        db.rollback()
+        return False
+
+
+def _replay(row: models.IdempotencyKey) -> JSONResponse:
+    return JSONResponse(content=row.response, status_code=row.status_code)
+
+
+def start(db: Session, key: Optional[str], endpoint: str, payload: BaseModel) -> Optional[JSONResponse]:
+    """
+    Registrar el inicio de una solicitud idempotente.
+
+    Devuelve la respuesta guardada si la llave ya se completó; None si la
+    solicitud actual debe ejecutarse (o si no se envió llave).
+    """
+    if not key:
+        return None
+    if len(key) > MAX_KEY_LENGTH:
+        raise HTTPException(status_code=400, detail="Idempotency-Key demasiado larga")
+
+    _maybe_purge(db)
+    request_hash = _fingerprint(endpoint, payload)
+    if _claim(db, key, request_hash):
+        return None
+
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_SECONDS
+    while True:
+        row = db.query(models.IdempotencyKey).populate_existing().filter(
+            models.IdempotencyKey.key == key
+        ).first()
+
+        if row is None:
+            # La solicitud original falló y liberó la llave
+            if _claim(db, key, request_hash):
+                return None
+            continue
+
+        if row.request_hash != request_hash:
+            raise HTTPException(
+                status_code=422,
+                detail="Idempotency-Key ya usada con una solicitud diferente"
+            )
+
+        if row.status_code is not None:
+            return _replay(row)
+
+        # Pendiente: si quedó abandonada, tomarla; si no, esperar a la original
+        if datetime.utcnow() - row.created_at > timedelta(seconds=IDEMPOTENCY_STALE_SECONDS):
+            taken = db.execute(
+                update(models.IdempotencyKey)
+                .where(models.IdempotencyKey.key == key)
+                .where(models.IdempotencyKey.created_at == row.created_at)
+                .where(models.IdempotencyKey.status_code.is_(None))
+                .values(created_at=datetime.utcnow())
+            ).rowcount
+            db.commit()
+            if taken:
+                return None
+            continue
+
+        if time.monotonic() >= deadline:
+            raise HTTPException(status_code=409, detail="Solicitud con la misma Idempotency-Key en proceso")
+        db.rollback()
+        time.sleep(0.1)
+
+
+def finish(db: Session, key: Optional[str], response: Union[BaseModel, dict, None], status_code: int):
+    """Guardar la respuesta en la sesión actual; se confirma junto con el registro creado"""
+    if not key:
+        return
+    if isinstance(response, BaseModel):
+        response = response.model_dump(mode="json")
+    db.execute(
+        update(models.IdempotencyKey)
+        .where(models.IdempotencyKey.key == key)
+        .values(response=response, status_code=status_code)
+    )
+
+
+def release(db: Session, key: Optional[str]):
+    """Liberar la llave cuando la solicitud falla, para que un reintento pueda ejecutarse"""
+    if not key:
+        return
+    db.rollback()
+    db.execute(
+        delete(models.IdempotencyKey)
+        .where(models.IdempotencyKey.key == key)
+        .where(models.IdempotencyKey.status_code.is_(None))
+    )
+    db.commit()
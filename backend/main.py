@@ -1,9 +1,16 @@
-from fastapi import FastAPI, Depends, HTTPException, UploadFile, File, status
+from fastapi import FastAPI, Depends, Header, HTTPException, Query, UploadFile, File, status
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse
-from sqlalchemy.orm import Session
+from fastapi.responses import FileResponse, JSONResponse
+from fastapi.encoders import jsonable_encoder
+from pydantic import ValidationError
+from sqlalchemy import func, literal, select, union_all
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session, selectinload
 from typing import List, Optional
+from contextlib import asynccontextmanager
+import asyncio
+import json
 import os
 import shutil
 from datetime import datetime
@@ -11,20 +18,38 @@ from dotenv import load_dotenv
 
 import models
 import schemas
+import archive
+import migrations
+import idempotency
+import sync
 from database import engine, get_db
 from pdf_generator import generate_vehicle_receipt
 
 # Cargar variables de entorno
 load_dotenv()
 
-# Crear tablas
+# Crear tablas nuevas y migrar las existentes
 models.Base.metadata.create_all(bind=engine)
+migrations.run_migrations(engine)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Job programado de archivo de trabajos cerrados
+    task = None
+    if archive.ARCHIVE_INTERVAL_HOURS > 0:
+        task = asyncio.create_task(archive.archive_scheduler())
+    yield
+    if task:
+        task.cancel()
+
 
 # Inicializar FastAPI
 app = FastAPI(
     title="Taller Autos API",
     description="API para gestión de taller mecánico con registro de vehículos y defectos",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # Configurar CORS
@@ -62,7 +87,10 @@ def read_root():
             "docs": "/docs",
             "vehicles": "/api/vehicles",
             "owners": "/api/owners",
-            "defects": "/api/defects"
+            "defects": "/api/defects",
+            "plates": "/api/plates/{placas}/timeline",
+            "archive": "/api/archive",
+            "sync": "/api/sync"
         }
     }
 
@@ -97,28 +125,60 @@ def get_owner(owner_id: int, db: Session = Depends(get_db)):
 
 # ==================== VEHICLES ====================
 
+def _find_active_visit(db: Session, placas: str) -> Optional[models.Vehicle]:
+    """Buscar la visita abierta (sin fecha de salida) de unas placas"""
+    return db.query(models.Vehicle).filter(
+        models.Vehicle.placas == placas,
+        models.Vehicle.fecha_salida.is_(None)
+    ).first()
+
+
 @app.post("/api/vehicles", response_model=schemas.Vehicle, status_code=status.HTTP_201_CREATED)
-def create_vehicle(vehicle: schemas.VehicleCreate, db: Session = Depends(get_db)):
-    """Crear un nuevo registro de vehículo"""
-    # Si se proporciona información del propietario, crearlo
-    if vehicle.propietario and not vehicle.propietario_id:
-        owner = models.Owner(**vehicle.propietario.dict())
-        db.add(owner)
-        db.commit()
-        db.refresh(owner)
-        propietario_id = owner.id
-    elif vehicle.propietario_id:
-        propietario_id = vehicle.propietario_id
-    else:
-        raise HTTPException(status_code=400, detail="Debe proporcionar propietario_id o datos del propietario")
+def create_vehicle(
+    vehicle: schemas.VehicleCreate,
+    idempotency_key: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
+    """Crear un nuevo registro de vehículo (una visita al taller)"""
+    replay = idempotency.start(db, idempotency_key, "POST /api/vehicles", vehicle)
+    if replay:
+        return replay
     
-    # Crear vehículo
-    vehicle_data = vehicle.dict(exclude={'propietario'})
-    vehicle_data['propietario_id'] = propietario_id
+    try:
+        # Si se proporciona información del propietario, crearlo
+        if vehicle.propietario and not vehicle.propietario_id:
+            owner = models.Owner(**vehicle.propietario.dict())
+            db.add(owner)
+            # Sin commit: propietario y vehículo se confirman juntos
+            db.flush()
+            propietario_id = owner.id
+        elif vehicle.propietario_id:
+            propietario_id = vehicle.propietario_id
+        else:
+            raise HTTPException(status_code=400, detail="Debe proporcionar propietario_id o datos del propietario")
+        
+        # Un auto que regresa genera una nueva visita, pero solo puede tener una abierta
+        if _find_active_visit(db, vehicle.placas):
+            raise HTTPException(status_code=409, detail="Ya hay una visita abierta con esas placas")
+        
+        # Crear vehículo
+        vehicle_data = vehicle.dict(exclude={'propietario'})
+        vehicle_data['propietario_id'] = propietario_id
+        
+        db_vehicle = models.Vehicle(**vehicle_data)
+        db.add(db_vehicle)
+        try:
+            db.flush()
+        except IntegrityError:
+            # Otra solicitud abrió una visita con las mismas placas al mismo tiempo
+            raise HTTPException(status_code=409, detail="Ya hay una visita abierta con esas placas")
+        db.refresh(db_vehicle)
+        idempotency.finish(db, idempotency_key, schemas.Vehicle.model_validate(db_vehicle), status.HTTP_201_CREATED)
+        db.commit()
+    except Exception:
+        idempotency.release(db, idempotency_key)
+        raise
     
-    db_vehicle = models.Vehicle(**vehicle_data)
-    db.add(db_vehicle)
-    db.commit()
     db.refresh(db_vehicle)
     return db_vehicle
 
@@ -128,11 +188,15 @@ def get_vehicles(
     skip: int = 0,
     limit: int = 100,
     activos: Optional[bool] = None,
+    placas: Optional[str] = None,
     db: Session = Depends(get_db)
 ):
     """Obtener lista de vehículos"""
     query = db.query(models.Vehicle)
     
+    if placas:
+        query = query.filter(models.Vehicle.placas == schemas.normalize_placas(placas))
+    
     if activos is not None:
         if activos:
             query = query.filter(models.Vehicle.fecha_salida.is_(None))
@@ -147,56 +211,151 @@ def get_vehicles(
 def get_vehicle(vehicle_id: int, db: Session = Depends(get_db)):
     """Obtener un vehículo por ID con toda su información"""
     vehicle = db.query(models.Vehicle).filter(models.Vehicle.id == vehicle_id).first()
+    if not vehicle:
+        # Buscar en el archivo de trabajos cerrados
+        vehicle = archive.get_archived_vehicle(db, vehicle_id)
     if not vehicle:
         raise HTTPException(status_code=404, detail="Vehículo no encontrado")
     return vehicle
 
 
-@app.put("/api/vehicles/{vehicle_id}", response_model=schemas.Vehicle)
-def update_vehicle(
-    vehicle_id: int,
-    vehicle_update: schemas.VehicleUpdate,
-    db: Session = Depends(get_db)
-):
-    """Actualizar información de un vehículo"""
+def _update_vehicle(db: Session, vehicle_id: int, vehicle_update: schemas.VehicleUpdate) -> models.Vehicle:
+    """Aplicar los cambios a un vehículo sin confirmar la transacción"""
     db_vehicle = db.query(models.Vehicle).filter(models.Vehicle.id == vehicle_id).first()
     if not db_vehicle:
         raise HTTPException(status_code=404, detail="Vehículo no encontrado")
     
     update_data = vehicle_update.dict(exclude_unset=True)
+    placas = update_data.get("placas")
+    if placas and placas != db_vehicle.placas and db_vehicle.fecha_salida is None:
+        active = _find_active_visit(db, placas)
+        if active and active.id != db_vehicle.id:
+            raise HTTPException(status_code=409, detail="Ya hay una visita abierta con esas placas")
+    
     for key, value in update_data.items():
         setattr(db_vehicle, key, value)
     
-    db.commit()
-    db.refresh(db_vehicle)
+    try:
+        db.flush()
+    except IntegrityError:
+        db.rollback()
+        raise HTTPException(status_code=409, detail="Ya hay una visita abierta con esas placas")
     return db_vehicle
 
 
-@app.delete("/api/vehicles/{vehicle_id}", status_code=status.HTTP_204_NO_CONTENT)
-def delete_vehicle(vehicle_id: int, db: Session = Depends(get_db)):
-    """Eliminar un vehículo"""
+def _delete_vehicle(db: Session, vehicle_id: int):
+    """Borrar un vehículo y registrar su tombstone sin confirmar la transacción"""
     db_vehicle = db.query(models.Vehicle).filter(models.Vehicle.id == vehicle_id).first()
     if not db_vehicle:
         raise HTTPException(status_code=404, detail="Vehículo no encontrado")
     
+    sync.record_vehicle_tombstones(db, [vehicle_id])
     db.delete(db_vehicle)
+    db.flush()
+
+
+@app.put("/api/vehicles/{vehicle_id}", response_model=schemas.Vehicle)
+def update_vehicle(
+    vehicle_id: int,
+    vehicle_update: schemas.VehicleUpdate,
+    db: Session = Depends(get_db)
+):
+    """Actualizar información de un vehículo"""
+    db_vehicle = _update_vehicle(db, vehicle_id, vehicle_update)
+    db.commit()
+    db.refresh(db_vehicle)
+    return db_vehicle
+
+
+@app.delete("/api/vehicles/{vehicle_id}", status_code=status.HTTP_204_NO_CONTENT)
+def delete_vehicle(vehicle_id: int, db: Session = Depends(get_db)):
+    """Eliminar un vehículo"""
+    _delete_vehicle(db, vehicle_id)
     db.commit()
     return None
 
 
+# ==================== PLATES ====================
+
+@app.get("/api/plates/{placas}/timeline", response_model=schemas.PlateTimeline)
+def get_plate_timeline(
+    placas: str,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=100),
+    db: Session = Depends(get_db)
+):
+    """Obtener todas las visitas de unas placas, activas y archivadas, de la más reciente a la más antigua"""
+    placas = schemas.normalize_placas(placas)
+    sources = (models.Vehicle, models.ArchivedVehicle)
+    
+    # Paginar primero solo los IDs de ambas tablas; cada rama usa el índice (placas, fecha_ingreso)
+    visits = union_all(*[
+        select(
+            model.id.label("id"),
+            model.fecha_ingreso.label("fecha_ingreso"),
+            literal(archived).label("archivado")
+        ).where(model.placas == placas)
+        for archived, model in enumerate(sources)
+    ]).subquery()
+    total = db.execute(select(func.count()).select_from(visits)).scalar()
+    page = db.execute(
+        select(visits.c.id, visits.c.archivado)
+        .order_by(visits.c.fecha_ingreso.desc(), visits.c.id.desc())
+        .offset(skip)
+        .limit(limit)
+    ).all()
+    
+    # Cargar completas solo las visitas de la página, con sus relaciones en lote
+    loaded = {}
+    for archived, model in enumerate(sources):
+        ids = [row.id for row in page if row.archivado == archived]
+        if not ids:
+            continue
+        for visit in db.query(model).options(
+            selectinload(model.propietario),
+            selectinload(model.defectos),
+            selectinload(model.historial)
+        ).filter(model.id.in_(ids)):
+            loaded[(archived, visit.id)] = visit
+    
+    return {
+        "placas": placas,
+        "total": total,
+        "skip": skip,
+        "limit": limit,
+        "visitas": [loaded[(row.archivado, row.id)] for row in page]
+    }
+
+
 # ==================== DEFECTS ====================
 
 @app.post("/api/defects", response_model=schemas.Defect, status_code=status.HTTP_201_CREATED)
-def create_defect(defect: schemas.DefectCreate, db: Session = Depends(get_db)):
+def create_defect(
+    defect: schemas.DefectCreate,
+    idempotency_key: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
     """Registrar un nuevo defecto"""
-    # Verificar que el vehículo existe
-    vehicle = db.query(models.Vehicle).filter(models.Vehicle.id == defect.vehiculo_id).first()
-    if not vehicle:
-        raise HTTPException(status_code=404, detail="Vehículo no encontrado")
+    replay = idempotency.start(db, idempotency_key, "POST /api/defects", defect)
+    if replay:
+        return replay
+    
+    try:
+        # Verificar que el vehículo existe
+        vehicle = db.query(models.Vehicle).filter(models.Vehicle.id == defect.vehiculo_id).first()
+        if not vehicle:
+            raise HTTPException(status_code=404, detail="Vehículo no encontrado")
+        
+        db_defect = models.Defect(**defect.dict())
+        db.add(db_defect)
+        db.flush()
+        db.refresh(db_defect)
+        idempotency.finish(db, idempotency_key, schemas.Defect.model_validate(db_defect), status.HTTP_201_CREATED)
+        db.commit()
+    except Exception:
+        idempotency.release(db, idempotency_key)
+        raise
     
-    db_defect = models.Defect(**defect.dict())
-    db.add(db_defect)
-    db.commit()
     db.refresh(db_defect)
     return db_defect
 
@@ -204,7 +363,8 @@ def create_defect(defect: schemas.DefectCreate, db: Session = Depends(get_db)):
 @app.get("/api/defects/vehicle/{vehicle_id}", response_model=List[schemas.Defect])
 def get_vehicle_defects(vehicle_id: int, db: Session = Depends(get_db)):
     """Obtener todos los defectos de un vehículo"""
-    defects = db.query(models.Defect).filter(models.Defect.vehiculo_id == vehicle_id).all()
+    model = models.ArchivedDefect if archive.is_archived(db, vehicle_id) else models.Defect
+    defects = db.query(model).filter(model.vehiculo_id == vehicle_id).all()
     return defects
 
 
@@ -240,6 +400,8 @@ def generate_receipt(vehicle_id: int, db: Session = Depends(get_db)):
     """Generar PDF de comprobante de ingreso"""
     # Obtener vehículo con toda la información
     vehicle = db.query(models.Vehicle).filter(models.Vehicle.id == vehicle_id).first()
+    if not vehicle:
+        vehicle = archive.get_archived_vehicle(db, vehicle_id)
     if not vehicle:
         raise HTTPException(status_code=404, detail="Vehículo no encontrado")
     
@@ -291,15 +453,31 @@ def generate_receipt(vehicle_id: int, db: Session = Depends(get_db)):
 # ==================== SERVICE HISTORY ====================
 
 @app.post("/api/service-history", response_model=schemas.ServiceHistory, status_code=status.HTTP_201_CREATED)
-def create_service_history(service: schemas.ServiceHistoryCreate, db: Session = Depends(get_db)):
+def create_service_history(
+    service: schemas.ServiceHistoryCreate,
+    idempotency_key: Optional[str] = Header(None),
+    db: Session = Depends(get_db)
+):
     """Agregar una entrada al historial de servicio"""
-    vehicle = db.query(models.Vehicle).filter(models.Vehicle.id == service.vehiculo_id).first()
-    if not vehicle:
-        raise HTTPException(status_code=404, detail="Vehículo no encontrado")
+    replay = idempotency.start(db, idempotency_key, "POST /api/service-history", service)
+    if replay:
+        return replay
+    
+    try:
+        vehicle = db.query(models.Vehicle).filter(models.Vehicle.id == service.vehiculo_id).first()
+        if not vehicle:
+            raise HTTPException(status_code=404, detail="Vehículo no encontrado")
+        
+        db_service = models.ServiceHistory(**service.dict())
+        db.add(db_service)
+        db.flush()
+        db.refresh(db_service)
+        idempotency.finish(db, idempotency_key, schemas.ServiceHistory.model_validate(db_service), status.HTTP_201_CREATED)
+        db.commit()
+    except Exception:
+        idempotency.release(db, idempotency_key)
+        raise
     
-    db_service = models.ServiceHistory(**service.dict())
-    db.add(db_service)
-    db.commit()
     db.refresh(db_service)
     return db_service
 
@@ -307,12 +485,156 @@ def create_service_history(service: schemas.ServiceHistoryCreate, db: Session =
 @app.get("/api/service-history/vehicle/{vehicle_id}", response_model=List[schemas.ServiceHistory])
 def get_vehicle_service_history(vehicle_id: int, db: Session = Depends(get_db)):
     """Obtener historial de servicio de un vehículo"""
-    history = db.query(models.ServiceHistory).filter(
-        models.ServiceHistory.vehiculo_id == vehicle_id
-    ).order_by(models.ServiceHistory.fecha_servicio.desc()).all()
+    model = models.ArchivedServiceHistory if archive.is_archived(db, vehicle_id) else models.ServiceHistory
+    history = db.query(model).filter(
+        model.vehiculo_id == vehicle_id
+    ).order_by(model.fecha_servicio.desc()).all()
     return history
 
 
+# ==================== ARCHIVE ====================
+
+@app.post("/api/archive/run")
+def run_archive(
+    older_than_days: Optional[int] = Query(None, ge=0),
+    db: Session = Depends(get_db)
+):
+    """Archivar ahora los trabajos cerrados hace más de older_than_days días"""
+    archivados = archive.archive_closed_vehicles(db, older_than_days=older_than_days)
+    return {"archivados": archivados}
+
+
+@app.get("/api/archive/vehicles", response_model=List[schemas.Vehicle])
+def get_archived_vehicles(skip: int = 0, limit: int = 100, db: Session = Depends(get_db)):
+    """Obtener lista de vehículos archivados"""
+    vehicles = db.query(models.ArchivedVehicle).order_by(
+        models.ArchivedVehicle.id.desc()
+    ).offset(skip).limit(limit).all()
+    return vehicles
+
+
+@app.post("/api/archive/vehicles/{vehicle_id}/restore", response_model=schemas.Vehicle)
+def restore_archived_vehicle(vehicle_id: int, db: Session = Depends(get_db)):
+    """Regresar un vehículo archivado a las tablas activas"""
+    vehicle = archive.restore_vehicle(db, vehicle_id)
+    if not vehicle:
+        raise HTTPException(status_code=404, detail="Vehículo archivado no encontrado")
+    return vehicle
+
+
+
+# ==================== SYNC ====================
+
+@app.get("/api/sync", response_model=schemas.SyncPull)
+def pull_sync(
+    since: Optional[datetime] = None,
+    limit: int = Query(500, ge=1, le=2000),
+    db: Session = Depends(get_db)
+):
+    """
+    Obtener los cambios posteriores al watermark `since` (sin él, todo).
+    `limit` es por tipo de registro y puede excederse cuando muchas filas
+    comparten el mismo updated_at en el corte de la página.
+    Si `has_more` es verdadero, repetir con el watermark devuelto.
+    Si `reset` es verdadero, el cliente debe descartar su copia local.
+    """
+    return sync.pull_changes(db, since, limit)
+
+
+def _apply_vehicle_change(op: schemas.SyncOperation, vehiculo_id: int, db: Session):
+    """
+    update_vehicle / delete_vehicle con la misma Idempotency-Key que los create_*:
+    reenviar el lote devuelve el resultado guardado en vez de un conflicto o un 404.
+    """
+    replay = idempotency.start(db, op.idempotency_key, f"SYNC {op.op}", op)
+    if replay:
+        return replay.status_code, json.loads(replay.body)
+    
+    try:
+        if op.op == "delete_vehicle":
+            _delete_vehicle(db, vehiculo_id)
+            status_code, data = status.HTTP_204_NO_CONTENT, None
+        else:
+            current = db.query(models.Vehicle).filter(models.Vehicle.id == vehiculo_id).first()
+            base_updated_at = sync.to_naive_utc(op.base_updated_at)
+            if current and base_updated_at and current.updated_at and current.updated_at > base_updated_at:
+                raise HTTPException(status_code=409, detail="El vehículo fue modificado en el servidor")
+            db_vehicle = _update_vehicle(db, vehiculo_id, schemas.VehicleUpdate(**op.data))
+            db.refresh(db_vehicle)
+            status_code = status.HTTP_200_OK
+            data = schemas.Vehicle.model_validate(db_vehicle).model_dump(mode="json")
+        idempotency.finish(db, op.idempotency_key, data, status_code)
+        db.commit()
+    except Exception:
+        idempotency.release(db, op.idempotency_key)
+        raise
+    return status_code, data
+
+
+def _apply_sync_operation(op: schemas.SyncOperation, refs: dict, db: Session):
+    """Ejecutar una operación de la cola offline; devuelve (status_code, data)"""
+    vehiculo_id = op.vehiculo_id
+    if op.vehiculo_ref:
+        if op.vehiculo_ref not in refs:
+            raise HTTPException(status_code=400, detail="Referencia de vehículo desconocida")
+        vehiculo_id = refs[op.vehiculo_ref]
+    
+    if op.op == "create_vehicle":
+        result = create_vehicle(schemas.VehicleCreate(**op.data), op.idempotency_key, db)
+        response_model, status_code = schemas.Vehicle, status.HTTP_201_CREATED
+    elif op.op == "create_defect":
+        data = {**op.data, "vehiculo_id": vehiculo_id or op.data.get("vehiculo_id")}
+        result = create_defect(schemas.DefectCreate(**data), op.idempotency_key, db)
+        response_model, status_code = schemas.Defect, status.HTTP_201_CREATED
+    elif op.op == "create_service_history":
+        data = {**op.data, "vehiculo_id": vehiculo_id or op.data.get("vehiculo_id")}
+        result = create_service_history(schemas.ServiceHistoryCreate(**data), op.idempotency_key, db)
+        response_model, status_code = schemas.ServiceHistory, status.HTTP_201_CREATED
+    else:
+        if vehiculo_id is None:
+            raise HTTPException(status_code=400, detail="Falta vehiculo_id")
+        return _apply_vehicle_change(op, vehiculo_id, db)
+    
+    # Respuesta repetida de una Idempotency-Key ya usada
+    if isinstance(result, JSONResponse):
+        return result.status_code, json.loads(result.body)
+    return status_code, response_model.model_validate(result).model_dump(mode="json")
+
+
+@app.post("/api/sync/push", response_model=schemas.SyncPushResponse)
+def push_sync(batch: schemas.SyncPushRequest, db: Session = Depends(get_db)):
+    """
+    Aplicar en orden las ediciones encoladas offline. Cada operación se confirma
+    por separado y tiene su propio resultado. Como todas llevan Idempotency-Key,
+    reenviar el mismo lote tras perder la respuesta es seguro: las ya aplicadas
+    devuelven su resultado guardado.
+    """
+    refs = {}
+    resultados = []
+    for index, op in enumerate(batch.operaciones):
+        try:
+            status_code, data = _apply_sync_operation(op, refs, db)
+            detail = None
+        except HTTPException as e:
+            db.rollback()
+            status_code, data, detail = e.status_code, None, e.detail
+        except ValidationError as e:
+            db.rollback()
+            status_code, data = 422, None
+            detail = jsonable_encoder(e.errors(include_url=False))
+        
+        if op.ref and op.op == "create_vehicle" and data:
+            refs[op.ref] = data["id"]
+        resultados.append({
+            "index": index,
+            "status_code": status_code,
+            "ref": op.ref,
+            "data": data,
+            "detail": detail
+        })
+    return {"resultados": resultados}
+
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
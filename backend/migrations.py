@@ -0,0 +1,164 @@
+"""
+Migraciones de esquema al iniciar.
+
+create_all solo crea tablas nuevas; no modifica las que ya existen en un
+taller.db anterior. Estos pasos revisan el esquema real de SQLite y lo
+ajustan a los modelos. Son idempotentes: en una base al día no hacen nada.
+"""
+import logging
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.schema import CreateTable
+
+import models
+
+logger = logging.getLogger(__name__)
+
+# (tabla activa, tabla de archivo): las activas necesitan AUTOINCREMENT
+# para no reutilizar IDs que ya se movieron al archivo
+_AUTOINCREMENT_TABLES = [
+    (models.Vehicle.__table__, models.ArchivedVehicle.__table__),
+    (models.Defect.__table__, models.ArchivedDefect.__table__),
+    (models.ServiceHistory.__table__, models.ArchivedServiceHistory.__table__),
+]
+
+
+def _table_sql(conn: Connection, name: str) -> str:
+    return conn.execute(
+        text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {"name": name}
+    ).scalar() or ""
+
+
+def _column_names(conn: Connection, name: str) -> list:
+    return [row[1] for row in conn.exec_driver_sql(f"PRAGMA table_info({name})")]
+
+
+def _rebuild_table(conn: Connection, table):
+    """Recrear una tabla con la definición del modelo conservando sus filas"""
+    logger.info("Reconstruyendo tabla %s", table.name)
+    tmp_name = f"{table.name}_new"
+    create_sql = str(CreateTable(table).compile(dialect=conn.dialect)).replace(
+        f"CREATE TABLE {table.name} ", f"CREATE TABLE {tmp_name} ", 1
+    )
+    columns = [c for c in _column_names(conn, table.name) if c in table.c]
+    column_list = ", ".join(columns)
+
+    conn.exec_driver_sql(f"DROP TABLE IF EXISTS {tmp_name}")
+    conn.exec_driver_sql(create_sql)
+    conn.exec_driver_sql(
+        f"INSERT INTO {tmp_name} ({column_list}) SELECT {column_list} FROM {table.name}"
+    )
+    # Borrar la vieja y renombrar la nueva: las llaves foráneas de otras
+    # tablas siguen apuntando al nombre original
+    conn.exec_driver_sql(f"DROP TABLE {table.name}")
+    conn.exec_driver_sql(f"ALTER TABLE {tmp_name} RENAME TO {table.name}")
+
+
+def _ensure_autoincrement(conn: Connection):
+    for table, archived in _AUTOINCREMENT_TABLES:
+        if "AUTOINCREMENT" in _table_sql(conn, table.name).upper():
+            continue
+        _rebuild_table(conn, table)
+        # El contador de AUTOINCREMENT también debe quedar arriba de los IDs
+        # que ya estén en el archivo
+        params = {"name": table.name}
+        archived_max = f"(SELECT COALESCE(MAX(id), 0) FROM {archived.name})"
+        conn.execute(
+            text(f"UPDATE sqlite_sequence SET seq = MAX(seq, {archived_max}) WHERE name = :name"),
+            params
+        )
+        conn.execute(
+            text(
+                f"INSERT INTO sqlite_sequence (name, seq) SELECT :name, {archived_max} "
+                f"WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = :name)"
+            ),
+            params
+        )
+
+
+def _drop_unique_placas(conn: Connection):
+    """Versiones anteriores tenían UNIQUE(placas); ahora cada regreso es una visita nueva"""
+    unique_constraints = [
+        row for row in conn.exec_driver_sql("PRAGMA index_list(vehicles)")
+        if row[2] and row[3] == "u"
+    ]
+    if unique_constraints:
+        _rebuild_table(conn, models.Vehicle.__table__)
+
+
+def _normalize_placas(conn: Connection):
+    """Aplicar a las placas existentes la misma normalización que schemas.normalize_placas"""
+    normalized = "placas"
+    for char in ("' '", "char(9)", "char(10)", "char(13)"):
+        normalized = f"REPLACE({normalized}, {char}, '')"
+    normalized = f"UPPER({normalized})"
+    for table in (models.Vehicle.__table__, models.ArchivedVehicle.__table__):
+        conn.exec_driver_sql(
+            f"UPDATE {table.name} SET placas = {normalized} WHERE placas != {normalized}"
+        )
+
+
+def _open_plate_duplicates(conn: Connection) -> list:
+    return conn.exec_driver_sql(
+        "SELECT placas FROM vehicles WHERE fecha_salida IS NULL "
+        "GROUP BY placas HAVING COUNT(*) > 1"
+    ).scalars().all()
+
+
+def _add_missing_columns(conn: Connection):
+    """ALTER TABLE ADD COLUMN para columnas nuevas (nullables) de los modelos"""
+    for table in models.Base.metadata.sorted_tables:
+        existing = _column_names(conn, table.name)
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            logger.info("Agregando columna %s.%s", table.name, column.name)
+            column_type = column.type.compile(dialect=conn.dialect)
+            conn.exec_driver_sql(
+                f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+            )
+
+
+def _backfill_updated_at(conn: Connection):
+    """Dar updated_at a filas creadas antes de la sincronización incremental"""
+    sources = {
+        models.Owner.__table__: "created_at",
+        models.Vehicle.__table__: "COALESCE(fecha_salida, fecha_ingreso)",
+        models.Defect.__table__: "fecha_registro",
+        models.ServiceHistory.__table__: "fecha_servicio",
+    }
+    for table, source in sources.items():
+        conn.exec_driver_sql(
+            f"UPDATE {table.name} SET updated_at = COALESCE({source}, CURRENT_TIMESTAMP) "
+            f"WHERE updated_at IS NULL"
+        )
+
+
+def _ensure_indexes(conn: Connection):
+    for table in models.Base.metadata.sorted_tables:
+        for index in table.indexes:
+            if index.name == "uq_vehicles_placas_abierta":
+                duplicates = _open_plate_duplicates(conn)
+                if duplicates:
+                    # No se cierran visitas automáticamente: hay que resolverlas a mano
+                    logger.warning(
+                        "Placas con más de una visita abierta, no se crea %s: %s",
+                        index.name, ", ".join(duplicates)
+                    )
+                    continue
+            index.create(conn, checkfirst=True)
+
+
+def run_migrations(engine: Engine):
+    """Llevar una base existente al esquema actual"""
+    if engine.dialect.name != "sqlite":
+        return
+    with engine.begin() as conn:
+        _ensure_autoincrement(conn)
+        _drop_unique_placas(conn)
+        _add_missing_columns(conn)
+        _normalize_placas(conn)
+        _backfill_updated_at(conn)
+        _ensure_indexes(conn)
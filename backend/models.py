@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, JSON
+from sqlalchemy import Column, Integer, String, Text, DateTime, ForeignKey, JSON, Index, text
 from sqlalchemy.orm import relationship
 from datetime import datetime
 from database import Base
@@ -11,20 +11,30 @@ class Owner(Base):
     nombre_completo = Column(String(200), nullable=False)
     telefono = Column(String(20), nullable=False)
     created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     # Relación con vehículos
     vehiculos = relationship("Vehicle", back_populates="propietario")
 
 
 class Vehicle(Base):
+    """Cada registro es una visita (orden de trabajo); un auto que regresa tiene varios"""
     __tablename__ = "vehicles"
+    __table_args__ = (
+        # Búsqueda por placas en recepción y línea de tiempo ordenada por ingreso
+        Index("ix_vehicles_placas_fecha_ingreso", "placas", "fecha_ingreso"),
+        # Solo una visita abierta (sin fecha de salida) por placas
+        Index("uq_vehicles_placas_abierta", "placas", unique=True, sqlite_where=text("fecha_salida IS NULL")),
+        # AUTOINCREMENT evita reutilizar IDs de registros movidos al archivo
+        {"sqlite_autoincrement": True},
+    )
     
     id = Column(Integer, primary_key=True, index=True)
     marca = Column(String(100), nullable=False)
     modelo = Column(String(100), nullable=False)
     anio = Column(Integer, nullable=False)
     color = Column(String(50), nullable=False)
-    placas = Column(String(20), unique=True, nullable=False)
+    placas = Column(String(20), nullable=False)
     problema_ingreso = Column(Text, nullable=False)
     
     # Foreign key al propietario
@@ -32,7 +42,8 @@ class Vehicle(Base):
     
     # Fechas
     fecha_ingreso = Column(DateTime, default=datetime.utcnow)
-    fecha_salida = Column(DateTime, nullable=True)
+    fecha_salida = Column(DateTime, nullable=True, index=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     # Relaciones
     propietario = relationship("Owner", back_populates="vehiculos")
@@ -42,9 +53,10 @@ class Vehicle(Base):
 
 class Defect(Base):
     __tablename__ = "defects"
+    __table_args__ = {"sqlite_autoincrement": True}
     
     id = Column(Integer, primary_key=True, index=True)
-    vehiculo_id = Column(Integer, ForeignKey("vehicles.id"), nullable=False)
+    vehiculo_id = Column(Integer, ForeignKey("vehicles.id"), nullable=False, index=True)
     descripcion = Column(Text, nullable=False)
     tipo = Column(String(50), nullable=False)  # 'golpe', 'rayón', 'abolladira', etc.
     ubicacion = Column(String(100), nullable=True)  # 'puerta delantera izquierda', etc.
@@ -52,6 +64,7 @@ class Defect(Base):
     detectado_automaticamente = Column(Integer, default=0)  # 0=manual, 1=AI
     deteccion_data = Column(JSON, nullable=True)  # Datos de la detección AI (bounding box, score, etc.)
     fecha_registro = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     # Relación
     vehiculo = relationship("Vehicle", back_populates="defectos")
@@ -59,14 +72,105 @@ class Defect(Base):
 
 class ServiceHistory(Base):
     __tablename__ = "service_history"
+    __table_args__ = {"sqlite_autoincrement": True}
     
     id = Column(Integer, primary_key=True, index=True)
-    vehiculo_id = Column(Integer, ForeignKey("vehicles.id"), nullable=False)
+    vehiculo_id = Column(Integer, ForeignKey("vehicles.id"), nullable=False, index=True)
     descripcion_servicio = Column(Text, nullable=False)
     costo = Column(Integer, nullable=True)
     fecha_servicio = Column(DateTime, default=datetime.utcnow)
     mecanico = Column(String(200), nullable=True)
     notas = Column(Text, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
     
     # Relación
     vehiculo = relationship("Vehicle", back_populates="historial")
+
+
+# ==================== ARCHIVO ====================
+# Trabajos cerrados antiguos se mueven a estas tablas para mantener
+# pequeñas las tablas activas. Conservan los mismos IDs que tenían.
+
+class ArchivedVehicle(Base):
+    __tablename__ = "archived_vehicles"
+    __table_args__ = (
+        Index("ix_archived_vehicles_placas_fecha_ingreso", "placas", "fecha_ingreso"),
+    )
+    
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    marca = Column(String(100), nullable=False)
+    modelo = Column(String(100), nullable=False)
+    anio = Column(Integer, nullable=False)
+    color = Column(String(50), nullable=False)
+    placas = Column(String(20), nullable=False)
+    problema_ingreso = Column(Text, nullable=False)
+    propietario_id = Column(Integer, ForeignKey("owners.id"), nullable=False)
+    fecha_ingreso = Column(DateTime)
+    fecha_salida = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime)
+    archivado_en = Column(DateTime, default=datetime.utcnow)
+    
+    # Relaciones
+    propietario = relationship("Owner")
+    defectos = relationship("ArchivedDefect", back_populates="vehiculo", cascade="all, delete-orphan")
+    historial = relationship("ArchivedServiceHistory", back_populates="vehiculo", cascade="all, delete-orphan")
+
+
+class ArchivedDefect(Base):
+    __tablename__ = "archived_defects"
+    
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    vehiculo_id = Column(Integer, ForeignKey("archived_vehicles.id"), nullable=False, index=True)
+    descripcion = Column(Text, nullable=False)
+    tipo = Column(String(50), nullable=False)
+    ubicacion = Column(String(100), nullable=True)
+    imagen_url = Column(String(500), nullable=True)
+    detectado_automaticamente = Column(Integer, default=0)
+    deteccion_data = Column(JSON, nullable=True)
+    fecha_registro = Column(DateTime)
+    updated_at = Column(DateTime)
+    
+    # Relación
+    vehiculo = relationship("ArchivedVehicle", back_populates="defectos")
+
+
+class ArchivedServiceHistory(Base):
+    __tablename__ = "archived_service_history"
+    
+    id = Column(Integer, primary_key=True, autoincrement=False)
+    vehiculo_id = Column(Integer, ForeignKey("archived_vehicles.id"), nullable=False, index=True)
+    descripcion_servicio = Column(Text, nullable=False)
+    costo = Column(Integer, nullable=True)
+    fecha_servicio = Column(DateTime)
+    mecanico = Column(String(200), nullable=True)
+    notas = Column(Text, nullable=True)
+    updated_at = Column(DateTime)
+    
+    # Relación
+    vehiculo = relationship("ArchivedVehicle", back_populates="historial")
+
+
+# ==================== IDEMPOTENCIA ====================
+
+class IdempotencyKey(Base):
+    """Respuesta guardada de un POST con Idempotency-Key; status_code nulo = en proceso"""
+    __tablename__ = "idempotency_keys"
+    
+    key = Column(String(64), primary_key=True)
+    request_hash = Column(String(64), nullable=False)
+    status_code = Column(Integer, nullable=True)
+    response = Column(JSON, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow, index=True)
+
+
+
+# ==================== SINCRONIZACIÓN ====================
+
+class Tombstone(Base):
+    """Registro borrado (o archivado) que los clientes sincronizados deben descartar"""
+    __tablename__ = "tombstones"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    entidad = Column(String(30), nullable=False)  # 'vehicle'; sus defectos e historial se descartan con él
+    entidad_id = Column(Integer, nullable=False)
+    eliminado_en = Column(DateTime, default=datetime.utcnow, index=True)
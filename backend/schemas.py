@@ -1,8 +1,13 @@
-from pydantic import BaseModel, Field
-from typing import Optional, List
+from pydantic import BaseModel, Field, field_validator
+from typing import Any, Literal, Optional, List
 from datetime import datetime
 
 
+def normalize_placas(placas: str) -> str:
+    """Normalizar placas (mayúsculas, sin espacios) para buscarlas por igualdad en el índice"""
+    return "".join(placas.split()).upper()
+
+
 # Owner Schemas
 class OwnerBase(BaseModel):
     nombre_completo: str = Field(..., min_length=1, max_length=200)
@@ -16,6 +21,7 @@ class OwnerCreate(OwnerBase):
 class Owner(OwnerBase):
     id: int
     created_at: datetime
+    updated_at: Optional[datetime] = None
 
     class Config:
         from_attributes = True
@@ -39,6 +45,7 @@ class Defect(DefectBase):
     id: int
     vehiculo_id: int
     fecha_registro: datetime
+    updated_at: Optional[datetime] = None
 
     class Config:
         from_attributes = True
@@ -60,6 +67,7 @@ class ServiceHistory(ServiceHistoryBase):
     id: int
     vehiculo_id: int
     fecha_servicio: datetime
+    updated_at: Optional[datetime] = None
 
     class Config:
         from_attributes = True
@@ -74,6 +82,11 @@ class VehicleBase(BaseModel):
     placas: str = Field(..., max_length=20)
     problema_ingreso: str
 
+    @field_validator("placas")
+    @classmethod
+    def _normalize_placas(cls, v: str) -> str:
+        return normalize_placas(v)
+
 
 class VehicleCreate(VehicleBase):
     propietario_id: Optional[int] = None
@@ -89,12 +102,31 @@ class VehicleUpdate(BaseModel):
     problema_ingreso: Optional[str] = None
     fecha_salida: Optional[datetime] = None
 
+    @field_validator("placas")
+    @classmethod
+    def _normalize_placas(cls, v: Optional[str]) -> Optional[str]:
+        return normalize_placas(v) if v is not None else v
+
+
+class VehicleSummary(VehicleBase):
+    """Vehículo sin relaciones anidadas, para la sincronización incremental"""
+    id: int
+    propietario_id: int
+    fecha_ingreso: datetime
+    fecha_salida: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+
+    class Config:
+        from_attributes = True
+
 
 class Vehicle(VehicleBase):
     id: int
     propietario_id: int
     fecha_ingreso: datetime
     fecha_salida: Optional[datetime] = None
+    updated_at: Optional[datetime] = None
+    archivado_en: Optional[datetime] = None
     propietario: Owner
     defectos: List[Defect] = []
     historial: List[ServiceHistory] = []
@@ -103,6 +135,71 @@ class Vehicle(VehicleBase):
         from_attributes = True
 
 
+# Plate Timeline Schemas
+class PlateTimeline(BaseModel):
+    placas: str
+    total: int
+    skip: int
+    limit: int
+    visitas: List[Vehicle] = []
+
+
+# Sync Schemas
+class Tombstone(BaseModel):
+    entidad: str
+    entidad_id: int
+    eliminado_en: datetime
+
+    class Config:
+        from_attributes = True
+
+
+class SyncPull(BaseModel):
+    watermark: datetime
+    reset: bool
+    has_more: bool
+    propietarios: List[Owner] = []
+    vehiculos: List[VehicleSummary] = []
+    defectos: List[Defect] = []
+    historial: List[ServiceHistory] = []
+    eliminados: List[Tombstone] = []
+
+
+class SyncOperation(BaseModel):
+    op: Literal[
+        "create_vehicle",
+        "update_vehicle",
+        "delete_vehicle",
+        "create_defect",
+        "create_service_history",
+    ]
+    data: dict = {}
+    # Obligatoria: se asigna al encolar la operación para que reenviar el lote sea seguro
+    idempotency_key: str = Field(..., min_length=1, max_length=64)
+    # Referencia local a un vehículo creado antes en el mismo lote
+    ref: Optional[str] = None
+    vehiculo_id: Optional[int] = None
+    vehiculo_ref: Optional[str] = None
+    # updated_at que tenía el cliente al editar; si el servidor es más nuevo hay conflicto
+    base_updated_at: Optional[datetime] = None
+
+
+class SyncPushRequest(BaseModel):
+    operaciones: List[SyncOperation] = Field(..., max_length=500)
+
+
+class SyncOperationResult(BaseModel):
+    index: int
+    status_code: int
+    ref: Optional[str] = None
+    data: Optional[dict] = None
+    detail: Optional[Any] = None
+
+
+class SyncPushResponse(BaseModel):
+    resultados: List[SyncOperationResult]
+
+
 # Damage Detection Response
 class DamageDetectionResult(BaseModel):
     detecciones: List[dict]
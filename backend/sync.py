@@ -0,0 +1,133 @@
+"""
+Sincronización incremental para tablets.
+
+Los clientes guardan el watermark que devuelve cada sincronización y en la
+siguiente solo reciben los registros con updated_at posterior, más los
+tombstones de vehículos borrados o archivados (sus defectos e historial se
+descartan junto con ellos).
+"""
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Iterable, Optional
+
+from dotenv import load_dotenv
+from sqlalchemy import delete, insert, literal, select
+from sqlalchemy.orm import Session
+
+import models
+
+load_dotenv()
+
+# Días que se conservan los tombstones; un cliente con watermark más viejo recibe todo de nuevo
+SYNC_TOMBSTONE_TTL_DAYS = int(os.getenv("SYNC_TOMBSTONE_TTL_DAYS", "30"))
+# Margen para no perder escrituras que se confirmaron mientras se armaba la respuesta
+SYNC_SAFETY_SECONDS = 2
+PURGE_INTERVAL_SECONDS = 3600
+
+# (llave en la respuesta, modelo, columna de cambios)
+_SOURCES = [
+    ("propietarios", models.Owner, models.Owner.updated_at),
+    ("vehiculos", models.Vehicle, models.Vehicle.updated_at),
+    ("defectos", models.Defect, models.Defect.updated_at),
+    ("historial", models.ServiceHistory, models.ServiceHistory.updated_at),
+    ("eliminados", models.Tombstone, models.Tombstone.eliminado_en),
+]
+
+_last_purge = 0.0
+
+
+def to_naive_utc(value: Optional[datetime]) -> Optional[datetime]:
+    """Las fechas se guardan en UTC sin zona; convertir las que vienen con offset (p. ej. 'Z')"""
+    if value is not None and value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def record_vehicle_tombstones(db: Session, vehicle_ids: Iterable[int]):
+    """Registrar tombstones para vehículos que salen de las tablas activas (sin commit)"""
+    ids = list(vehicle_ids)
+    if not ids:
+        return
+    db.execute(
+        insert(models.Tombstone).from_select(
+            ["entidad", "entidad_id"],
+            select(literal("vehicle"), models.Vehicle.id).where(models.Vehicle.id.in_(ids))
+        )
+    )
+
+
+def purge_tombstones(db: Session) -> int:
+    """Borrar tombstones más viejos que el TTL"""
+    cutoff = datetime.utcnow() - timedelta(days=SYNC_TOMBSTONE_TTL_DAYS)
+    result = db.execute(delete(models.Tombstone).where(models.Tombstone.eliminado_en < cutoff))
+    db.commit()
+    return result.rowcount
+
+
+def _maybe_purge(db: Session):
+    global _last_purge
+    now = time.monotonic()
+    if now - _last_purge >= PURGE_INTERVAL_SECONDS:
+        _last_purge = now
+        purge_tombstones(db)
+
+
+def pull_changes(db: Session, since: Optional[datetime], limit: int) -> dict:
+    """
+    Obtener los registros cambiados después de since, hasta limit por tipo.
+
+    Solo se envían cambios anteriores al horizonte (ahora - SYNC_SAFETY_SECONDS),
+    para no saltar escrituras con updated_at ya asignado que aún no se confirman.
+    limit no es estricto: si una página se corta en un instante compartido por
+    muchas filas (p. ej. todos los hijos de un vehículo restaurado), se incluyen
+    todas las de ese instante para que el siguiente pull avance.
+    """
+    _maybe_purge(db)
+    since = to_naive_utc(since)
+    started = datetime.utcnow()
+    horizon = started - timedelta(seconds=SYNC_SAFETY_SECONDS)
+
+    # Los tombstones anteriores al TTL pueden ya no existir: el cliente debe reconstruir todo
+    reset = since is not None and since < started - timedelta(days=SYNC_TOMBSTONE_TTL_DAYS)
+    if reset:
+        since = None
+
+    changes = {}
+    cut = None
+    for name, model, column in _SOURCES:
+        if name == "eliminados" and since is None:
+            # Una carga completa no necesita tombstones
+            changes[name] = []
+            continue
+        query = db.query(model).filter(column <= horizon)
+        if since is not None:
+            query = query.filter(column > since)
+        rows = query.order_by(column, model.id).limit(limit + 1).all()
+        if len(rows) > limit:
+            rows = rows[:limit]
+            boundary = getattr(rows[-1], column.key)
+            cut = boundary if cut is None else min(cut, boundary)
+        changes[name] = rows
+
+    if cut is None:
+        # Nunca retroceder el watermark si el cliente ya está más allá del horizonte
+        watermark = horizon if since is None else max(since, horizon)
+    else:
+        # Página parcial: cortar todos los tipos en el mismo instante, incluyendo
+        # todos los empates en el corte (sin límite) para que el siguiente pull avance con '>'
+        watermark = cut
+        for name, model, column in _SOURCES:
+            rows = [r for r in changes[name] if getattr(r, column.key) < cut]
+            if changes[name]:
+                rows += db.query(model).filter(column == cut, column <= horizon).order_by(model.id).all()
+            changes[name] = rows
+
+    # Nunca enviar como eliminado un vehículo que va vivo en la misma respuesta
+    live_ids = {v.id for v in changes["vehiculos"]}
+    changes["eliminados"] = [
+        t for t in changes["eliminados"]
+        if not (t.entidad == "vehicle" and t.entidad_id in live_ids)
+    ]
+
+    return {"watermark": watermark, "reset": reset, "has_more": cut is not None, **changes}
@@ -15,6 +15,7 @@ export interface Owner {
   nombre_completo: string;
   telefono: string;
   created_at: string;
+  updated_at?: string | null;
 }
 
 export interface Defect {
@@ -27,6 +28,7 @@ export interface Defect {
   detectado_automaticamente: number;
   deteccion_data: any;
   fecha_registro: string;
+  updated_at?: string | null;
 }
 
 export interface ServiceHistory {
@@ -37,6 +39,7 @@ export interface ServiceHistory {
   fecha_servicio: string;
   mecanico: string | null;
   notas: string | null;
+  updated_at?: string | null;
 }
 
 export interface Vehicle {
@@ -50,11 +53,60 @@ export interface Vehicle {
   propietario_id: number;
   fecha_ingreso: string;
   fecha_salida: string | null;
+  updated_at?: string | null;
+  archivado_en?: string | null;
   propietario: Owner;
   defectos: Defect[];
   historial: ServiceHistory[];
 }
 
+export interface PlateTimeline {
+  placas: string;
+  total: number;
+  skip: number;
+  limit: number;
+  visitas: Vehicle[];
+}
+
+export type VehicleSummary = Omit<Vehicle, 'propietario' | 'defectos' | 'historial' | 'archivado_en'>;
+
+export interface Tombstone {
+  entidad: string;
+  entidad_id: number;
+  eliminado_en: string;
+}
+
+export interface SyncPull {
+  watermark: string;
+  reset: boolean;
+  has_more: boolean;
+  propietarios: Owner[];
+  vehiculos: VehicleSummary[];
+  defectos: Defect[];
+  historial: ServiceHistory[];
+  eliminados: Tombstone[];
+}
+
+// Toda operación lleva su Idempotency-Key desde que se encola (ver newIdempotencyKey),
+// para que reenviar la misma cola no duplique ni repita cambios
+export interface SyncOperation {
+  op: 'create_vehicle' | 'update_vehicle' | 'delete_vehicle' | 'create_defect' | 'create_service_history';
+  idempotency_key: string;
+  data?: Record<string, unknown>;
+  ref?: string;
+  vehiculo_id?: number;
+  vehiculo_ref?: string;
+  base_updated_at?: string;
+}
+
+export interface SyncOperationResult {
+  index: number;
+  status_code: number;
+  ref: string | null;
+  data: Record<string, unknown> | null;
+  detail: unknown;
+}
+
 export interface VehicleCreate {
   marca: string;
   modelo: string;
@@ -69,6 +121,30 @@ export interface VehicleCreate {
   };
 }
 
+// Idempotency
+// crypto.randomUUID solo existe en contextos seguros; en la red local se usa el respaldo
+export const newIdempotencyKey = (): string =>
+  typeof crypto !== 'undefined' && 'randomUUID' in crypto
+    ? crypto.randomUUID()
+    : `${Date.now().toString(36)}-${Math.random().toString(36).slice(2)}`;
+
+// POST que reintenta errores de red con la misma Idempotency-Key,
+// así el servidor no duplica registros si la respuesta original se perdió
+const postIdempotent = async <T>(url: string, data: unknown, retries = 3): Promise<T> => {
+  const headers = { 'Idempotency-Key': newIdempotencyKey() };
+  for (let attempt = 0; ; attempt++) {
+    try {
+      const response = await api.post(url, data, { headers });
+      return response.data;
+    } catch (err) {
+      if (!axios.isAxiosError(err) || err.response || attempt >= retries) {
+        throw err;
+      }
+      await new Promise((resolve) => setTimeout(resolve, 500 * 2 ** attempt));
+    }
+  }
+};
+
 // API functions
 
 // Owners
@@ -95,8 +171,7 @@ export const getVehicle = async (id: number): Promise<Vehicle> => {
 };
 
 export const createVehicle = async (vehicle: VehicleCreate): Promise<Vehicle> => {
-  const response = await api.post('/api/vehicles', vehicle);
-  return response.data;
+  return postIdempotent<Vehicle>('/api/vehicles', vehicle);
 };
 
 export const updateVehicle = async (id: number, updates: Partial<Vehicle>): Promise<Vehicle> => {
@@ -108,6 +183,14 @@ export const deleteVehicle = async (id: number): Promise<void> => {
   await api.delete(`/api/vehicles/${id}`);
 };
 
+// Plates
+export const getPlateTimeline = async (placas: string, skip = 0, limit = 20): Promise<PlateTimeline> => {
+  const response = await api.get(`/api/plates/${encodeURIComponent(placas)}/timeline`, {
+    params: { skip, limit },
+  });
+  return response.data;
+};
+
 // Defects
 export const createDefect = async (defect: {
   vehiculo_id: number;
@@ -116,8 +199,7 @@ export const createDefect = async (defect: {
   ubicacion?: string;
   imagen_url?: string;
 }): Promise<Defect> => {
-  const response = await api.post('/api/defects', defect);
-  return response.data;
+  return postIdempotent<Defect>('/api/defects', defect);
 };
 
 export const getVehicleDefects = async (vehicleId: number): Promise<Defect[]> => {
@@ -141,8 +223,7 @@ export const createServiceHistory = async (service: {
   mecanico?: string;
   notas?: string;
 }): Promise<ServiceHistory> => {
-  const response = await api.post('/api/service-history', service);
-  return response.data;
+  return postIdempotent<ServiceHistory>('/api/service-history', service);
 };
 
 export const getVehicleServiceHistory = async (vehicleId: number): Promise<ServiceHistory[]> => {
@@ -150,4 +231,17 @@ export const getVehicleServiceHistory = async (vehicleId: number): Promise<Servi
   return response.data;
 };
 
+// Sync
+export const pullSync = async (since?: string, limit?: number): Promise<SyncPull> => {
+  const response = await api.get('/api/sync', { params: { since, limit } });
+  return response.data;
+};
+
+// Cada operación debe guardarse en la cola ya con su idempotency_key
+// (ver newIdempotencyKey) y reenviarse sin cambios si se pierde la respuesta
+export const pushSync = async (operaciones: SyncOperation[]): Promise<SyncOperationResult[]> => {
+  const response = await api.post('/api/sync/push', { operaciones });
+  return response.data.resultados;
+};
+
 export default api;